@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+bloom.py
+
+Minimal Bloom filter over strings, used as a membership pre-filter in
+front of the baseline index: a miss proves the item was never added, a
+hit has to be confirmed with an exact lookup. At the default error
+rate the bit array costs about 2.4 bytes per entry — a few MB for a
+million baseline paths, versus hundreds of MB for a Python set.
+"""
+
+import math
+import hashlib
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter with the classic m = -n*ln(p)/ln(2)^2
+    sizing and double hashing for the k probe positions. Lookups can
+    false-positive (at roughly error_rate once capacity is reached)
+    but never false-negative.
+    """
+
+    def __init__(self, capacity, error_rate=1e-4):
+        capacity = max(1, capacity)
+        num_bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.num_bits = max(64, num_bits)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # Two independent 64-bit halves of one blake2b digest combine
+        # into k probes (Kirsch-Mitzenmacher double hashing)
+        digest = hashlib.blake2b(
+            item.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+mbhash.py
+
+Multi-stream SHA-256 hashing of batches of independent files.
+
+The ideal backend here is a SIMD multi-buffer implementation (Intel
+ISA-L's sha256_mb schedules 8/16 independent streams through AVX2 /
+AVX-512 lanes at once). There is no maintained Python binding for it,
+but hashlib releases the GIL around its C update loop, so hashing N
+independent files from N threads already runs the SHA cores genuinely
+in parallel. Callers queue files into fixed-size lanes and flush a
+whole lane at a time, which also amortizes Python's per-file overhead.
+"""
+
+import os
+import concurrent.futures
+
+# How many independent streams to hash at once
+LANE_WIDTH = min(8, os.cpu_count() or 1)
+
+_pool = None
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ThreadPoolExecutor(max_workers=LANE_WIDTH)
+    return _pool
+
+def hash_files(paths, hash_one):
+    """
+    Hash a batch of independent files concurrently.
+
+    'hash_one' is the single-file hash function to apply (e.g.
+    calculate_sha256). Returns {path: hexdigest} where a failed file
+    maps to the exception that was raised instead of a digest.
+    """
+    results = {}
+    pool = _get_pool()
+    futures = {pool.submit(hash_one, path): path for path in paths}
+    for fut in concurrent.futures.as_completed(futures):
+        path = futures[fut]
+        try:
+            results[path] = fut.result()
+        except Exception as e:
+            results[path] = e
+    return results
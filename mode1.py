@@ -6,19 +6,45 @@ Usage:
   python3 mode1.py
 
 Description:
-  1) Creates a baseline directory by scanning the filesystem.
-  2) If a file is larger than 1MB, store a .hash file with its SHA256.
-  3) Otherwise, copy the file fully.
-  4) Tars the 'baseline' directory to 'baseline.tar.gz'.
-  5) Removes the 'baseline' directory.
+  1) Scans the filesystem and streams the baseline straight into the
+     archive ('baseline.tar.zst', or 'baseline.tar.gz' if zstandard
+     isn't installed) — no intermediate baseline directory on disk.
+  2) If a file is larger than 1MB, a .hash member with its SHA256 and
+     stat metadata goes into the archive.
+  3) Otherwise, the file itself is added to the archive.
 """
 
+import io
 import os
-import shutil
+import re
+import mmap
 import hashlib
+import ssl
+import struct
+import queue
 import tarfile
+import threading
+import contextlib
+import concurrent.futures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import mbhash
 
 SIZE_THRESHOLD = 1 * 1024 * 1024  # 1MB
+MMAP_THRESHOLD = 8 * 1024 * 1024  # hash via a single mmap above this
+BATCH_SIZE = 64  # files per process-pool dispatch, amortizes pickling
+QUEUE_DEPTH = 1024  # walker-to-consumer job queue bound, for backpressure
+MAX_INFLIGHT = 4 * (os.cpu_count() or 1)  # pending hash batches before we drain
+ARC_ROOT = 'baseline'  # top-level folder name inside the archive
+# .hash record: raw SHA-256 digest then size/mtime_ns/ctime_ns/ino as
+# little-endian u64 — one fixed-offset read instead of text parsing
+HASH_STRUCT = struct.Struct('<32sQQQQ')
+# Resolved once so the per-file hot path doesn't re-do the lookup
+_file_digest = getattr(hashlib, 'file_digest', None)
 SKIP_DIRS = {
     '/proc',
     '/sys',
@@ -28,94 +54,277 @@ SKIP_DIRS = {
     '/var/run',
     # Add more as needed
 }
+# One compiled prefix match instead of a startswith scan per SKIP_DIRS
+# entry; (?:/|$) stops /run from also matching e.g. /runway
+_SKIP_RE = re.compile(
+    '^(?:' + '|'.join(re.escape(sd) for sd in sorted(SKIP_DIRS)) + ')(?:/|$)')
+
+def drop_page_cache(fd):
+    """
+    Tell the kernel we're done with this file's pages, so scanning the
+    whole disk doesn't evict everyone else's working set.
+    """
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except (AttributeError, OSError):
+        pass
 
-def calculate_sha256(file_path, chunk_size=65536):
+def calculate_sha256(file_path, chunk_size=1024 * 1024):
     """
-    Calculate SHA-256 hash of a file.
+    Calculate SHA-256 hash of a file, returned as the raw 32-byte
+    digest — half the memory of a hex string, and comparisons are a
+    single memcmp. Call .hex() on the result where text is needed.
+
+    Files above MMAP_THRESHOLD are memory-mapped and fed to the hash in
+    one C-level update — no per-chunk syscalls or Python round-trips.
+    Smaller files go through hashlib.file_digest (Python 3.11+), which
+    runs the read/update loop in C against the OpenSSL backend; either
+    way SHA-NI gets used on CPUs that have it. A sequential-readahead
+    fadvise hint cuts cold-cache stalls on the read path.
     """
-    sha256 = hashlib.sha256()
     with open(file_path, 'rb') as f:
+        fd = f.fileno()
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        if os.fstat(fd).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                sha256 = hashlib.sha256()
+                sha256.update(mm)
+            drop_page_cache(fd)
+            return sha256.digest()
+        if _file_digest is not None:
+            digest = _file_digest(f, 'sha256').digest()
+            drop_page_cache(fd)
+            return digest
+        # Fallback for Python < 3.11
+        sha256 = hashlib.sha256()
         for chunk in iter(lambda: f.read(chunk_size), b''):
             sha256.update(chunk)
-    return sha256.hexdigest()
+        drop_page_cache(fd)
+    return sha256.digest()
+
+def hash_batch(jobs):
+    """
+    Worker: hash a batch of (src, arcname, meta) large-file jobs in
+    multi-stream lanes, where meta is (size, mtime_ns, ctime_ns, ino).
+    Returns ([(arcname, meta, hexdigest)], [error messages]); the main
+    process turns the results into .hash archive members.
+    """
+    results = []
+    errors = []
+    for i in range(0, len(jobs), mbhash.LANE_WIDTH):
+        lane = jobs[i:i + mbhash.LANE_WIDTH]
+        digests = mbhash.hash_files([src for src, _, _ in lane], calculate_sha256)
+        for src, arcname, meta in lane:
+            file_hash = digests[src]
+            if isinstance(file_hash, Exception):
+                errors.append(f"Error processing {src}: {file_hash}")
+            else:
+                results.append((arcname, meta, file_hash))
+    return results, errors
 
-def mode1(root_dir='/', baseline_dir='./baseline', baseline_tar='baseline.tar.gz'):
+def add_hash_member(tar, arcname, meta, file_hash):
     """
-    1) Walk 'root_dir', skip system dirs, build the 'baseline_dir'.
-    2) Tar up 'baseline_dir' into 'baseline.tar.gz'.
-    3) Remove 'baseline_dir'.
+    Write a large file's .hash record directly into the archive.
     """
+    size, mtime_ns, ctime_ns, ino = meta
+    blob = HASH_STRUCT.pack(file_hash, size, mtime_ns, ctime_ns, ino)
+    info = tarfile.TarInfo(arcname + '.hash')
+    info.size = len(blob)
+    info.mtime = mtime_ns // 1_000_000_000
+    tar.addfile(info, io.BytesIO(blob))
+
+def mode1(root_dir='/', baseline_tar=None):
+    """
+    Walk 'root_dir', skip system dirs, and stream the baseline straight
+    into the archive: small files are added whole, large files as .hash
+    records. Every byte is read once and written once (compressed) —
+    nothing is staged on disk first.
+    """
+
+    if baseline_tar is None:
+        baseline_tar = 'baseline.tar.zst' if zstandard is not None else 'baseline.tar.gz'
 
     root_dir = os.path.abspath(root_dir)
-    baseline_dir = os.path.abspath(baseline_dir)
     baseline_tar = os.path.abspath(baseline_tar)
 
-    print(f"Building baseline from {root_dir} into {baseline_dir}...")
-
-    # Create the baseline directory
-    os.makedirs(baseline_dir, exist_ok=True)
-
-    for dirpath, dirnames, filenames in os.walk(root_dir, followlinks=False):
-        # Skip special directories
-        abs_dirpath = os.path.abspath(dirpath)
-
-        # Also skip if it's our baseline directory or the tar file's path
-        # (in case someone put baseline_tar in root_dir)
-        if abs_dirpath.startswith(baseline_dir) or abs_dirpath in SKIP_DIRS:
-            dirnames[:] = []
-            filenames[:] = []
-            continue
-
-        # Also skip if this directory is in SKIP_DIRS by prefix
-        if any(abs_dirpath.startswith(sd) for sd in SKIP_DIRS):
-            dirnames[:] = []
-            filenames[:] = []
-            continue
-
-        # Figure out the corresponding path inside baseline_dir
-        rel_path = os.path.relpath(abs_dirpath, root_dir)
-        if rel_path == '.':
-            rel_path = ''
-        sub_baseline_dir = os.path.join(baseline_dir, rel_path)
-        os.makedirs(sub_baseline_dir, exist_ok=True)
-
-        # Process files
-        for fname in filenames:
-            src = os.path.join(abs_dirpath, fname)
-            # Skip if it's not a regular file
-            if not os.path.isfile(src):
-                continue
-
-            dst = os.path.join(sub_baseline_dir, fname)
-            try:
-                size = os.path.getsize(src)
-                if size > SIZE_THRESHOLD:
-                    # Large file => store .hash
-                    file_hash = calculate_sha256(src)
-                    with open(dst + '.hash', 'w') as hf:
-                        hf.write(f"HASH: {file_hash}\nSIZE: {size}\n")
+    print(f"Streaming baseline from {root_dir} into {baseline_tar}...")
+    # So we can confirm sha256 is backed by an SHA-NI-capable OpenSSL
+    print(f"Hashing with {ssl.OPENSSL_VERSION} "
+          f"(sha256 available: {'sha256' in hashlib.algorithms_available})")
+
+    with contextlib.ExitStack() as stack:
+        # Zstd at level 3 compresses about as well as gzip but several
+        # times faster, and spreads the work over all cores (threads=-1);
+        # gzip stays as the fallback.
+        try:
+            if zstandard is not None:
+                raw = stack.enter_context(open(baseline_tar, 'wb'))
+                cctx = zstandard.ZstdCompressor(level=3, threads=-1)
+                stream = stack.enter_context(cctx.stream_writer(raw))
+                tar = stack.enter_context(tarfile.open(fileobj=stream, mode='w|'))
+            else:
+                tar = stack.enter_context(tarfile.open(baseline_tar, 'w:gz'))
+        except Exception as e:
+            print(f"Error creating tar archive: {e}")
+            return
+
+        # Bounded job queue between the walker thread and this thread,
+        # so directory scanning overlaps hashing and tar writing but
+        # can't run arbitrarily far ahead of them
+        jobs = queue.Queue(maxsize=QUEUE_DEPTH)
+
+        def walker():
+            """
+            Producer: walk the tree and enqueue ('dir'|'small'|'hash',
+            src, arcname, meta) jobs while the main thread streams the
+            tar and the pool hashes.
+            """
+            # root_dir is absolute, so every path popped off the stack is
+            # too; relative paths are a plain slice past this prefix
+            # instead of an os.path.relpath call per directory
+            prefix_len = len(root_dir.rstrip('/')) + 1
+
+            # os.scandir hands back the file type and stat data cached from
+            # reading the directory itself, so no extra stat syscalls per file
+            dirs_to_scan = [root_dir]
+            while dirs_to_scan:
+                abs_dirpath = dirs_to_scan.pop()
+
+                # Skip special directories (exact or by prefix)
+                if _SKIP_RE.match(abs_dirpath):
+                    continue
+
+                # Figure out the corresponding path inside the archive
+                rel_path = abs_dirpath[prefix_len:]
+                if rel_path:
+                    arc_dir = ARC_ROOT + '/' + rel_path
                 else:
-                    # Small file => copy fully
-                    shutil.copy2(src, dst)
-            except Exception as e:
-                print(f"Error processing {src}: {e}")
+                    arc_dir = ARC_ROOT
 
-    # Now tar the baseline directory
-    print(f"Creating tar archive {baseline_tar}...")
-    try:
-        with tarfile.open(baseline_tar, "w:gz") as tar:
-            # arcname sets how it appears inside the tar
-            tar.add(baseline_dir, arcname=os.path.basename(baseline_dir))
-    except Exception as e:
-        print(f"Error creating tar archive: {e}")
-        return
-
-    # Remove the baseline directory
-    print(f"Removing uncompressed baseline directory {baseline_dir}...")
-    try:
-        shutil.rmtree(baseline_dir)
-    except Exception as e:
-        print(f"Error removing baseline directory: {e}")
+                try:
+                    entries = os.scandir(abs_dirpath)
+                except OSError as e:
+                    print(f"Error scanning {abs_dirpath}: {e}")
+                    continue
+
+                jobs.put(('dir', abs_dirpath, arc_dir, None))
+
+                # Bucket the directory's files into two size classes,
+                # then emit each class as one homogeneous run: the
+                # consumer gets an unbroken streak of tar writes and
+                # then an unbroken streak of hash jobs, so pool batches
+                # fill without interleaving and the per-file hash/copy
+                # branch disappears from the dispatch loop
+                size_classes = ([], [])  # (small, large)
+                with entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                dirs_to_scan.append(entry.path)
+                                continue
+                            # Skip if it's not a regular file
+                            if not entry.is_file(follow_symlinks=False):
+                                continue
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError as e:
+                            print(f"Error processing {entry.path}: {e}")
+                            continue
+
+                        # Don't try to archive the archive itself
+                        if entry.path == baseline_tar:
+                            continue
+
+                        size_classes[st.st_size > SIZE_THRESHOLD].append(
+                            (entry.path, entry.name, st))
+
+                small_files, large_files = size_classes
+                for src, name, st in small_files:
+                    jobs.put(('small', src, arc_dir + '/' + name, None))
+                for src, name, st in large_files:
+                    meta = (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+                    jobs.put(('hash', src, arc_dir + '/' + name, meta))
+
+            jobs.put(None)  # walk finished
+
+        # Consumer: this thread owns the tar writer; small files stream
+        # into it directly, large files are farmed out to the pool and
+        # their .hash records written as batches complete
+        with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            walker_thread = threading.Thread(target=walker, name='walker')
+            walker_thread.start()
+
+            futures = set()
+            batch = []
+
+            def write_results(done):
+                for fut in done:
+                    results, errors = fut.result()
+                    for arcname, meta, file_hash in results:
+                        try:
+                            add_hash_member(tar, arcname, meta, file_hash)
+                        except Exception as e:
+                            print(f"Error archiving {arcname}: {e}")
+                    for err in errors:
+                        print(err)
+
+            while True:
+                job = jobs.get()
+                if job is None:
+                    break
+                kind, src, arcname, meta = job
+
+                if kind == 'dir':
+                    # Record the directory itself so empty dirs survive
+                    try:
+                        tar.addfile(tar.gettarinfo(src, arcname=arcname))
+                    except OSError as e:
+                        print(f"Error archiving {src}: {e}")
+                elif kind == 'small':
+                    # Small file => read it whole, then add it to the
+                    # tar. Buffering first matters on a live tree: a
+                    # file truncated between the stat and the read
+                    # would otherwise leave a member header whose
+                    # declared size desyncs every reader behind it, so
+                    # the header is sized from the bytes actually read.
+                    # These files are at most SIZE_THRESHOLD, so the
+                    # buffer stays small.
+                    try:
+                        info = tar.gettarinfo(src, arcname=arcname)
+                        if info.isreg():
+                            with open(src, 'rb') as f:
+                                data = f.read()
+                                drop_page_cache(f.fileno())
+                            info.size = len(data)
+                            tar.addfile(info, io.BytesIO(data))
+                        else:
+                            # Hardlink to an already-added member:
+                            # carries no content
+                            tar.addfile(info)
+                    except Exception as e:
+                        print(f"Error processing {src}: {e}")
+                else:
+                    # Large file => queue for hashing in a worker
+                    batch.append((src, arcname, meta))
+                    if len(batch) >= BATCH_SIZE:
+                        futures.add(pool.submit(hash_batch, batch))
+                        batch = []
+                        if len(futures) >= MAX_INFLIGHT:
+                            done, futures = concurrent.futures.wait(
+                                futures,
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+                            write_results(done)
+
+            if batch:
+                futures.add(pool.submit(hash_batch, batch))
+
+            # Drain the remaining workers and write their .hash records
+            for fut in concurrent.futures.as_completed(futures):
+                write_results([fut])
+
+            walker_thread.join()
 
     print(f"Baseline complete. Tar saved to {baseline_tar}.")
 
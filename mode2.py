@@ -6,19 +6,44 @@ Usage:
   python3 mode2.py
 
 Description:
-  1) Untars the 'baseline.tar.gz' into a temporary directory.
-  2) Compares the extracted baseline to the current filesystem.
+  1) Streams the baseline archive (baseline.tar.zst or baseline.tar.gz)
+     into a disk-backed index — nothing is extracted to disk.
+  2) Compares the baseline index to the current filesystem.
      - Only prints out NEW, MODIFIED, REMOVED differences (no UNCHANGED).
-  3) Deletes the temporary extracted baseline.
 """
 
 import os
+import re
+import mmap
+import queue
 import tarfile
 import tempfile
-import shutil
+import threading
 import hashlib
+import ssl
+import struct
+import sqlite3
+import concurrent.futures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import bloom
+import mbhash
 
 SIZE_THRESHOLD = 1 * 1024 * 1024  # 1MB
+MMAP_THRESHOLD = 8 * 1024 * 1024  # hash via a single mmap above this
+BATCH_SIZE = 64  # files per process-pool dispatch, amortizes pickling
+QUEUE_DEPTH = 1024  # walker-to-consumer job queue bound, for backpressure
+MAX_INFLIGHT = 4 * (os.cpu_count() or 1)  # pending compare batches before we drain
+# .hash record: raw SHA-256 digest then size/mtime_ns/ctime_ns/ino as
+# little-endian u64 — one fixed-offset read instead of text parsing
+HASH_STRUCT = struct.Struct('<32sQQQQ')
+DB_BATCH = 10000  # rows per executemany flush when (un)loading the store
+# Resolved once so the per-file hot path doesn't re-do the lookup
+_file_digest = getattr(hashlib, 'file_digest', None)
 SKIP_DIRS = {
     '/proc',
     '/sys',
@@ -28,85 +53,277 @@ SKIP_DIRS = {
     '/var/run',
     # add more as needed
 }
+# One compiled prefix match instead of a startswith scan per SKIP_DIRS
+# entry; (?:/|$) stops /run from also matching e.g. /runway
+_SKIP_RE = re.compile(
+    '^(?:' + '|'.join(re.escape(sd) for sd in sorted(SKIP_DIRS)) + ')(?:/|$)')
 
-def calculate_sha256(file_path, chunk_size=65536):
-    sha256 = hashlib.sha256()
+def drop_page_cache(fd):
+    """
+    Tell the kernel we're done with this file's pages, so scanning the
+    whole disk doesn't evict everyone else's working set.
+    """
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except (AttributeError, OSError):
+        pass
+
+def calculate_sha256(file_path, chunk_size=1024 * 1024):
+    # Returns the raw 32-byte digest; comparisons are a single memcmp
+    # and storage is half that of a hex string.
+    # Big files get memory-mapped and hashed in one C-level update;
+    # smaller ones go through hashlib.file_digest (Python 3.11+), which
+    # keeps the read/update loop in C against OpenSSL. SHA-NI gets used
+    # either way where the CPU supports it.
     with open(file_path, 'rb') as f:
+        fd = f.fileno()
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        if os.fstat(fd).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                sha256 = hashlib.sha256()
+                sha256.update(mm)
+            drop_page_cache(fd)
+            return sha256.digest()
+        if _file_digest is not None:
+            digest = _file_digest(f, 'sha256').digest()
+            drop_page_cache(fd)
+            return digest
+        # Fallback for Python < 3.11
+        sha256 = hashlib.sha256()
         for chunk in iter(lambda: f.read(chunk_size), b''):
             sha256.update(chunk)
-    return sha256.hexdigest()
-
-def load_baseline(baseline_dir):
-    """
-    Walk the extracted baseline_dir and build a dictionary:
-      { relative_file_path: {"is_large": bool, "hash": <sha256 or None>, "size": int } }
-
-    If we see *.hash => is_large = True, parse the hash/size from the file.
-    Else => it's a small file copy => is_large = False.
-    """
-    baseline_info = {}
-
-    for dirpath, dirnames, filenames in os.walk(baseline_dir, followlinks=False):
-        rel_dir = os.path.relpath(dirpath, baseline_dir)
-        if rel_dir == ".":
-            rel_dir = ""
-
-        for fname in filenames:
-            full_path = os.path.join(dirpath, fname)
-
-            if fname.endswith(".hash"):
-                # large file
-                base_name = fname[:-5]  # remove ".hash"
-                rel_file_path = os.path.join(rel_dir, base_name)
-                # parse
-                file_hash = None
-                file_size = None
-                try:
-                    with open(full_path, "r") as hf:
-                        for line in hf:
-                            line = line.strip()
-                            if line.startswith("HASH: "):
-                                file_hash = line.split("HASH: ", 1)[1]
-                            elif line.startswith("SIZE: "):
-                                file_size = int(line.split("SIZE: ", 1)[1])
-                except Exception as e:
-                    print(f"Error reading {full_path}: {e}")
-
-                baseline_info[rel_file_path] = {
-                    "is_large": True,
-                    "hash": file_hash,
-                    "size": file_size,
-                }
-            else:
-                # small file
-                rel_file_path = os.path.join(rel_dir, fname)
-                try:
-                    file_size = os.path.getsize(full_path)
-                except:
-                    file_size = None
-                baseline_info[rel_file_path] = {
-                    "is_large": False,
-                    "hash": None,
-                    "size": file_size,
-                }
-
-    return baseline_info
-
-def compare_small_files(current_file, baseline_file):
-    """
-    Compare two small files by hashing. Return True if identical, False otherwise.
-    """
-    return calculate_sha256(current_file) == calculate_sha256(baseline_file)
-
-def mode2(root_dir='/', baseline_tar='baseline.tar.gz'):
-    """
-    1) Untar the baseline_tar into a temp directory.
-    2) Load the baseline data.
-    3) Compare with the current filesystem, skipping special dirs.
+        drop_page_cache(fd)
+    return sha256.digest()
+
+# Digests already computed this run, keyed on (dev, ino, size, mtime_ns)
+# — keyed on the inode rather than the path so hardlinks to an
+# already-hashed file are free. Module-level, so each pool worker keeps
+# its own copy.
+_hash_cache = {}
+
+def cached_sha256(file_path):
+    """
+    calculate_sha256 memoized per run: a file seen twice (or reachable
+    through several hardlinks, common under /usr and container layers)
+    is only read and hashed once.
+    """
+    st = os.stat(file_path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    digest = _hash_cache.get(key)
+    if digest is None:
+        digest = calculate_sha256(file_path)
+        _hash_cache[key] = digest
+    return digest
+
+def open_baseline_db(db_path):
+    """
+    Open the disk-backed store for baseline records. A full / baseline
+    holds millions of entries; as a dict of dicts that's GBs of Python
+    object overhead, while SQLite keeps it in mmap'd pages on disk and
+    still answers point lookups through the primary-key index.
+    """
+    db = sqlite3.connect(db_path)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA mmap_size = 1073741824")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        " path TEXT PRIMARY KEY,"
+        " is_large INT,"
+        " hash BLOB,"
+        " size INT,"
+        " mtime_ns INT,"
+        " ino INT,"
+        " seen INT DEFAULT 0)")
+    return db
+
+def stream_sha256(fileobj, chunk_size=1024 * 1024):
+    """
+    SHA-256 of an already-open stream (a tar member), raw digest.
+    """
+    if _file_digest is not None:
+        return _file_digest(fileobj, 'sha256').digest()
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        sha256.update(chunk)
+    return sha256.digest()
+
+def load_baseline(tar, db):
+    """
+    Stream the baseline archive into the SQLite store in one sequential
+    pass — nothing is extracted to disk. .hash members are parsed in
+    memory; small-file members are hashed straight off the stream, so
+    only their digests are kept:
+      (path, is_large, hash, size, mtime_ns, ino)
+
+    Rows are inserted with executemany in batches inside one
+    transaction, so the load is a single sequential write.
+
+    Hardlinked files show up as LNKTYPE members (mode1 tars straight
+    from the source tree, so tarfile dedupes the second and later paths
+    to a multi-linked inode); they carry no content, only the name of
+    the member holding it. Those are buffered and resolved in a second
+    pass once the target rows are in the store, each getting a row that
+    copies the target's record.
+    """
+    rows = []
+    hard_links = []  # (path, path of the member holding the content)
+
+    def flush_rows():
+        db.executemany(
+            "INSERT OR REPLACE INTO files"
+            " (path, is_large, hash, size, mtime_ns, ino)"
+            " VALUES (?, ?, ?, ?, ?, ?)", rows)
+        rows.clear()
+
+    for member in tar:
+        if member.islnk():
+            _, _, rel_name = member.name.partition('/')
+            _, _, link_target = member.linkname.partition('/')
+            if rel_name and link_target:
+                hard_links.append((rel_name, link_target))
+            continue
+        if not member.isfile():
+            continue
+
+        # Strip the archive's top-level folder ('baseline/')
+        _, _, rel_name = member.name.partition('/')
+        if not rel_name:
+            continue
+
+        if rel_name.endswith(".hash"):
+            # large file
+            rel_file_path = rel_name[:-5]  # remove ".hash"
+            # parse
+            file_hash = None
+            file_size = None
+            file_mtime = None
+            file_ino = None
+            try:
+                blob = tar.extractfile(member).read()
+                if len(blob) == HASH_STRUCT.size:
+                    file_hash, file_size, file_mtime, _ctime, file_ino = \
+                        HASH_STRUCT.unpack(blob)
+                else:
+                    # legacy text-format record
+                    for line in blob.decode().splitlines():
+                        line = line.strip()
+                        if line.startswith("HASH: "):
+                            file_hash = bytes.fromhex(
+                                line.split("HASH: ", 1)[1])
+                        elif line.startswith("SIZE: "):
+                            file_size = int(line.split("SIZE: ", 1)[1])
+                        elif line.startswith("MTIME: "):
+                            file_mtime = int(line.split("MTIME: ", 1)[1])
+                        elif line.startswith("INO: "):
+                            file_ino = int(line.split("INO: ", 1)[1])
+            except Exception as e:
+                print(f"Error reading {member.name}: {e}")
+
+            rows.append((rel_file_path, 1, file_hash, file_size,
+                         file_mtime, file_ino))
+        else:
+            # small file => keep its digest, not its contents
+            try:
+                src = tar.extractfile(member)
+                if src is None:
+                    continue
+                file_hash = stream_sha256(src)
+            except Exception as e:
+                print(f"Error reading {member.name}: {e}")
+                continue
+            rows.append((rel_name, 0, file_hash, member.size, None, None))
+
+        if len(rows) >= DB_BATCH:
+            flush_rows()
+
+    flush_rows()
+
+    # Second pass: every link target is now in the store (tarfile
+    # always emits the content-holding member before its links), so
+    # each hardlink gets a copy of its target's row
+    for rel_name, link_target in hard_links:
+        row = db.execute(
+            "SELECT is_large, hash, size, mtime_ns, ino"
+            " FROM files WHERE path = ?", (link_target,)).fetchone()
+        if row is None:
+            print(f"Error resolving hardlink {rel_name} -> {link_target}")
+            continue
+        rows.append((rel_name,) + row)
+        if len(rows) >= DB_BATCH:
+            flush_rows()
+
+    flush_rows()
+    db.commit()
+
+def flush_compares(pending):
+    """
+    Hash a lane of queued files ((current_file, baseline_digest)
+    tuples) as one multi-stream batch. Returns the report lines for any
+    mismatches or errors.
+    """
+    lines = []
+    if not pending:
+        return lines
+    results = mbhash.hash_files([path for path, _ in pending], cached_sha256)
+    for current_file, baseline_digest in pending:
+        current_digest = results[current_file]
+        if isinstance(current_digest, Exception):
+            lines.append(f"Error hashing {current_file}: {current_digest}")
+        elif current_digest != baseline_digest:
+            lines.append(f"MODIFIED: {current_file}")
+        # else it's unchanged => do not print
+    pending.clear()
+    return lines
+
+def compare_batch(jobs):
+    """
+    Worker: hash a batch of (current_file, baseline_digest) jobs in
+    multi-stream lanes and compare against the baseline digests.
+    Returns the report lines for the main process to print.
+    """
+    lines = []
+    for i in range(0, len(jobs), mbhash.LANE_WIDTH):
+        lines.extend(flush_compares(jobs[i:i + mbhash.LANE_WIDTH]))
+    return lines
+
+def open_baseline_tar(baseline_tar):
+    """
+    Open the baseline archive for reading, sniffing zstd vs gzip by
+    magic bytes so either format works regardless of file name.
+    """
+    with open(baseline_tar, 'rb') as f:
+        magic = f.read(4)
+    if magic == b'\x28\xb5\x2f\xfd':
+        if zstandard is None:
+            raise RuntimeError(
+                f"{baseline_tar} is zstd-compressed but the zstandard "
+                "module is not installed")
+        raw = open(baseline_tar, 'rb')
+        stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        return tarfile.open(fileobj=stream, mode='r|')
+    return tarfile.open(baseline_tar, 'r:gz')
+
+def mode2(root_dir='/', baseline_tar=None):
+    """
+    1) Stream the baseline_tar into the disk-backed index.
+    2) Compare with the current filesystem, skipping special dirs.
        - Only print NEW, MODIFIED, REMOVED (suppress UNCHANGED).
-    4) Remove the temp directory.
+    3) Remove the index.
     """
 
+    if baseline_tar is None:
+        for candidate in ('baseline.tar.zst', 'baseline.tar.gz'):
+            if os.path.isfile(candidate):
+                baseline_tar = candidate
+                break
+        else:
+            print("Error: cannot find baseline.tar.zst or baseline.tar.gz")
+            return
+
     root_dir = os.path.abspath(root_dir)
     baseline_tar = os.path.abspath(baseline_tar)
 
@@ -114,98 +331,181 @@ def mode2(root_dir='/', baseline_tar='baseline.tar.gz'):
         print(f"Error: cannot find {baseline_tar}")
         return
 
-    # 1) Extract tar to a temp dir
-    tempdir = tempfile.mkdtemp(prefix="baseline_extract_")
-    print(f"Extracting baseline to {tempdir} ...")
+    # So we can confirm sha256 is backed by an SHA-NI-capable OpenSSL
+    print(f"Hashing with {ssl.OPENSSL_VERSION} "
+          f"(sha256 available: {'sha256' in hashlib.algorithms_available})")
+
+    # 1) Stream the archive into the index — no extraction to disk
+    db_fd, db_path = tempfile.mkstemp(prefix="baseline_index_", suffix=".db")
+    os.close(db_fd)
+    print(f"Loading baseline from {baseline_tar} ...")
+    db = open_baseline_db(db_path)
     try:
-        with tarfile.open(baseline_tar, "r:gz") as tar:
-            tar.extractall(path=tempdir)
+        with open_baseline_tar(baseline_tar) as tar:
+            load_baseline(tar, db)
     except Exception as e:
-        print(f"Error extracting {baseline_tar}: {e}")
-        shutil.rmtree(tempdir, ignore_errors=True)
+        print(f"Error loading {baseline_tar}: {e}")
+        db.close()
+        os.unlink(db_path)
         return
 
-    # Typically, the tar might contain "baseline" as the top-level folder
-    # Let's find that folder
-    extracted_baseline_dir = None
-    for item in os.listdir(tempdir):
-        candidate = os.path.join(tempdir, item)
-        if os.path.isdir(candidate):
-            extracted_baseline_dir = candidate
-            break
-
-    if not extracted_baseline_dir:
-        print("Error: could not find extracted baseline directory!")
-        shutil.rmtree(tempdir, ignore_errors=True)
-        return
+    # Bloom pre-filter over the baseline paths: a miss proves a file
+    # was never in the baseline, so the common NEW case is answered
+    # from a few MB of bits without touching SQLite at all
+    count = db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    baseline_bloom = bloom.BloomFilter(count, error_rate=1e-4)
+    for (path,) in db.execute("SELECT path FROM files"):
+        baseline_bloom.add(path)
 
-    # 2) Load baseline data
-    baseline_info = load_baseline(extracted_baseline_dir)
+    # Baseline items found in the current filesystem get their 'seen'
+    # flag set in batches, so the REMOVED pass is one indexed scan
+    seen_paths = []
 
-    # Keep track of which baseline items we find in the current filesystem
-    found_in_current = set()
+    def flush_seen():
+        db.executemany("UPDATE files SET seen = 1 WHERE path = ?",
+                       [(p,) for p in seen_paths])
+        seen_paths.clear()
 
-    # 3) Walk the current filesystem and compare
-    for dirpath, dirnames, filenames in os.walk(root_dir, followlinks=False):
-        abs_dirpath = os.path.abspath(dirpath)
+    # Bounded job queue between the walker thread and this thread, so
+    # directory scanning overlaps the index lookups and hashing but
+    # can't run arbitrarily far ahead of them
+    jobs = queue.Queue(maxsize=QUEUE_DEPTH)
 
-        if any(abs_dirpath.startswith(sd) for sd in SKIP_DIRS):
-            dirnames[:] = []
-            filenames[:] = []
-            continue
+    def walker():
+        """
+        Producer: walk the current filesystem and enqueue
+        (current_file, rel_file_path) jobs while the main thread does
+        the index lookups and the pool hashes.
+        """
+        # root_dir is absolute, so every path popped off the stack is
+        # too; relative paths are a plain slice past this prefix
+        # instead of an os.path.relpath call per directory
+        prefix_len = len(root_dir.rstrip('/')) + 1
 
-        # Also skip if it's the baseline tar file directory or tempdir
-        if abs_dirpath.startswith(tempdir):
-            dirnames[:] = []
-            filenames[:] = []
-            continue
+        # os.scandir hands back the file type cached from reading the
+        # directory itself, so no extra stat syscalls per file
+        dirs_to_scan = [root_dir]
+        while dirs_to_scan:
+            abs_dirpath = dirs_to_scan.pop()
+
+            if _SKIP_RE.match(abs_dirpath):
+                continue
 
-        rel_dir = os.path.relpath(abs_dirpath, root_dir)
-        if rel_dir == ".":
-            rel_dir = ""
+            rel_dir = abs_dirpath[prefix_len:]
 
-        for fname in filenames:
-            current_file = os.path.join(abs_dirpath, fname)
-            if not os.path.isfile(current_file):
+            try:
+                entries = os.scandir(abs_dirpath)
+            except OSError as e:
+                print(f"Error scanning {abs_dirpath}: {e}")
                 continue
 
-            rel_file_path = os.path.join(rel_dir, fname)
-            found_in_current.add(rel_file_path)
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs_to_scan.append(entry.path)
+                            continue
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                    except OSError as e:
+                        print(f"Error processing {entry.path}: {e}")
+                        continue
+
+                    current_file = entry.path
+                    # Don't compare the archive against itself
+                    if current_file == baseline_tar:
+                        continue
 
-            if rel_file_path not in baseline_info:
-                # It's new
+                    jobs.put((current_file, os.path.join(rel_dir, entry.name)))
+
+        jobs.put(None)  # walk finished
+
+    # 2) Consumer: this thread owns the index; it classifies each file
+    #    as the walker hands it over and farms the hash compares out to
+    #    workers, printing their reports as batches complete
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        walker_thread = threading.Thread(target=walker, name='walker')
+        walker_thread.start()
+
+        futures = set()
+        batch = []
+
+        def print_results(done):
+            for fut in done:
+                for line in fut.result():
+                    print(line)
+
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            current_file, rel_file_path = job
+
+            if rel_file_path not in baseline_bloom:
+                # Definitely not in the baseline => new
                 print(f"NEW: {current_file}")
-            else:
-                # We have an entry in baseline
-                info = baseline_info[rel_file_path]
-                if info["is_large"]:
-                    # Compare the stored hash
-                    current_hash = calculate_sha256(current_file)
-                    if current_hash != info["hash"]:
-                        print(f"MODIFIED: {current_file}")
-                    # else it's unchanged => do not print
-                else:
-                    # It's a small file => we have a copy
-                    baseline_copy = os.path.join(extracted_baseline_dir, rel_file_path)
-                    # If the baseline copy doesn't exist for some reason, call it modified
-                    if not os.path.isfile(baseline_copy):
-                        print(f"MODIFIED: {current_file}")
-                    else:
-                        # Compare the two files
-                        if not compare_small_files(current_file, baseline_copy):
-                            print(f"MODIFIED: {current_file}")
-                        # else it's unchanged => do not print
-
-    # 4) Anything in baseline that isn't found in current => REMOVED
-    for rel_file_path in baseline_info:
-        if rel_file_path not in found_in_current:
-            # It's removed
-            print(f"REMOVED: {rel_file_path}")
+                continue
+
+            row = db.execute(
+                "SELECT is_large, hash, size, mtime_ns, ino"
+                " FROM files WHERE path = ?",
+                (rel_file_path,)).fetchone()
+            if row is None:
+                # Bloom false positive => still new
+                print(f"NEW: {current_file}")
+                continue
+
+            seen_paths.append(rel_file_path)
+            if len(seen_paths) >= DB_BATCH:
+                flush_seen()
+
+            # We have an entry in baseline
+            is_large, base_hash, base_size, base_mtime, base_ino = row
+            if is_large:
+                # Fast path: if size, mtime and inode all match the
+                # baseline record, the file can't have changed content
+                # => skip the hash entirely
+                if base_mtime is not None and base_ino is not None:
+                    try:
+                        st = os.lstat(current_file)
+                        if (st.st_size == base_size
+                                and st.st_mtime_ns == base_mtime
+                                and st.st_ino == base_ino):
+                            # unchanged => do not print
+                            continue
+                    except OSError:
+                        pass
+
+            # Compare against the stored digest (small and large files
+            # alike — the baseline only holds digests now)
+            batch.append((current_file, base_hash))
+            if len(batch) >= BATCH_SIZE:
+                futures.add(pool.submit(compare_batch, batch))
+                batch = []
+                if len(futures) >= MAX_INFLIGHT:
+                    done, futures = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    print_results(done)
+
+        if batch:
+            futures.add(pool.submit(compare_batch, batch))
+
+        for fut in concurrent.futures.as_completed(futures):
+            print_results([fut])
+
+        walker_thread.join()
+
+    # 3) Anything in baseline that isn't found in current => REMOVED
+    flush_seen()
+    for (rel_file_path,) in db.execute("SELECT path FROM files WHERE seen = 0"):
+        # It's removed
+        print(f"REMOVED: {rel_file_path}")
+    db.close()
 
     # Clean up
-    shutil.rmtree(tempdir, ignore_errors=True)
-    print("Done. Temporary extracted baseline removed.")
-    
+    os.unlink(db_path)
+    print("Done. Baseline index removed.")
+
 
 if __name__ == '__main__':
     mode2()